@@ -14,7 +14,10 @@ class Detector:
             raise Exception("Unknown Family!")
         self.parameters = aruco.DetectorParameters()
     def detect(self, img):
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if img.ndim == 2:
+            gray = img  # already luma
+        else:
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         corners, ids, rejectedImgPoints = aruco.detectMarkers(gray,
           self.aruco_dict, None, parameters=self.parameters)
         if not ids:
@@ -173,6 +173,18 @@ class ArducamUtils(object):
         dev.val = val
         return fcntl.ioctl(self.vd, VIDIOC_W_DEV, dev)
 
+    def get_ctrl(self, cid):
+        ctrl = v4l2.v4l2_control()
+        ctrl.id = cid
+        fcntl.ioctl(self.vd, v4l2.VIDIOC_G_CTRL, ctrl)
+        return ctrl.value
+
+    def set_ctrl(self, cid, val):
+        ctrl = v4l2.v4l2_control()
+        ctrl.id = cid
+        ctrl.value = val
+        return fcntl.ioctl(self.vd, v4l2.VIDIOC_S_CTRL, ctrl)
+
     def get_device_info(self):
         fw_sensor_id = self.read_dev(ArducamUtils.FIRMWARE_SENSOR_ID_REG)
         sensor_id = self.read_dev(ArducamUtils.SENSOR_ID_REG)
@@ -194,6 +206,25 @@ class ArducamUtils(object):
 
         return frame
 
+    # Single channel luma plane at half the sensor resolution.
+    # Bayer: average of the two green sites in each 2x2 cell, no debayer.
+    # Y10: the sensor data is already luminance, just decimate.
+    # frame is the raw h x w plane capture reshapes every read to.
+    def luma(self, frame):
+        if self.cvt_code == -1:
+            gray = np.ascontiguousarray(frame[0::2, 0::2])
+        else:
+            if self.cvt_code in (cv2.COLOR_BAYER_RG2BGR, cv2.COLOR_BAYER_BG2BGR):
+                g0, g1 = frame[0::2, 1::2], frame[1::2, 0::2]
+            else:
+                g0, g1 = frame[0::2, 0::2], frame[1::2, 1::2]
+            gray = (g0.astype(np.int32) + g1) >> 1
+
+        if self.depth != -1:
+            gray = cv2.convertScaleAbs(gray, None, 256.0 / (1 << self.depth))
+
+        return gray.astype(np.uint8)
+
     def get_pixelformat(self):
         fmt = v4l2.v4l2_format()
         fmt.type = v4l2.V4L2_BUF_TYPE_VIDEO_CAPTURE
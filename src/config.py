@@ -0,0 +1,354 @@
+import json
+from dataclasses import asdict, dataclass, fields, replace
+from functools import cached_property
+from multiprocessing import Value, shared_memory
+
+import yaml
+
+from utils import get_dim
+
+
+# Typed config
+# config.yaml is loaded and checked once into a Config, the processes read
+# attributes instead of indexing the raw dict. LiveConfig carries reloads
+# of the safe fields to the running processes through shared memory.
+
+
+@dataclass
+class Camera:
+    id: int
+    fovh: float
+    w: int
+    h: int
+    c: int
+    pformat: str
+    wr: int
+    luma: bool
+
+
+@dataclass
+class Marker:
+    cameraids: list
+    family: str
+    size: float
+    ids: list
+    max_age: float
+    workers: int
+
+
+@dataclass
+class Objdet:
+    cameraids: list
+    model: str
+    imgsz: int
+    conf: float
+    iou: float
+    depth: int
+    stats: float
+    max_age: float
+    workers: int
+
+
+@dataclass
+class Roi:
+    enable: bool
+    n: int
+    size: int
+    minside: float
+
+
+@dataclass
+class Autoexp:
+    enable: bool
+    rate: float
+    step: int
+    target: float
+    deadband: float
+    kp: float
+    exposure: list
+    gain: list
+    min_rate: float
+
+
+@dataclass
+class Tasks:
+    marker: bool
+    objdet: bool
+
+
+@dataclass
+class Display:
+    main: bool
+    marker: bool
+    objdet: bool
+
+
+@dataclass
+class FPS:
+    org: list
+    fontscale: float
+    color: list
+    thickness: int
+
+
+@dataclass
+class Config:
+    camera: Camera
+    marker: Marker
+    objdet: Objdet
+    roi: Roi
+    autoexp: Autoexp
+    tasks: Tasks
+    display: Display
+    FPS: FPS
+
+    @cached_property
+    def dim(self):
+        return get_dim(self.camera.w, self.camera.h, self.camera.wr)  # tw, th
+
+    @cached_property
+    def imw(self):
+        return self.camera.wr // 4  # one camera width
+
+    @cached_property
+    def frame_shape(self):
+        tw, th = self.dim
+        return (th, tw, self.camera.c)
+
+    @cached_property
+    def luma_shape(self):
+        tw, th = self.dim
+        return (th, tw)
+
+
+# fields that can change while running, "*" for the whole section
+# everything else sizes buffers or loads models and needs a restart
+RELOADABLE = {
+    "marker": {"cameraids", "ids", "max_age"},
+    "objdet": {"cameraids", "conf", "iou", "stats", "max_age"},
+    "roi": {"minside"},
+    "autoexp": {"rate", "target", "deadband", "kp", "exposure", "gain", "min_rate"},
+    "display": "*",
+    "FPS": "*",
+}
+
+
+def _section(cls, d, name):
+    if not isinstance(d, dict):
+        raise ValueError(f"config: {name} should be a mapping, got {d!r}")
+
+    names = {f.name for f in fields(cls)}
+    missing = names - d.keys()
+    unknown = d.keys() - names
+    if missing:
+        raise ValueError(f"config: {name} missing {sorted(missing)}")
+    if unknown:
+        raise ValueError(f"config: {name} unknown {sorted(unknown)}")
+
+    kw = {}
+    for f in fields(cls):
+        v = d[f.name]
+        if f.type is float and isinstance(v, int) and not isinstance(v, bool):
+            v = float(v)
+        if not isinstance(v, f.type) or (f.type is int and isinstance(v, bool)):
+            raise ValueError(
+                f"config: {name}.{f.name} should be {f.type.__name__}, got {v!r}"
+            )
+        kw[f.name] = v
+    return cls(**kw)
+
+
+def _check(cfg):
+    def need(ok, msg):
+        if not ok:
+            raise ValueError(f"config: {msg}")
+
+    # list elements, checked before any comparison on them
+    def ints(v):
+        return all(isinstance(x, int) and not isinstance(x, bool) for x in v)
+
+    def nums(v):
+        return all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in v)
+
+    cam = cfg.camera
+    need(cam.w > 0 and cam.h > 0, "camera.w, camera.h should be > 0")
+    need(0 < cam.wr <= cam.w, "camera.wr should be in (0, camera.w]")
+    need(cam.c in (1, 3), "camera.c should be 1 or 3")
+    need(len(cam.pformat) == 4, "camera.pformat should be a fourcc")
+
+    for name in ("marker", "objdet"):
+        ids = getattr(cfg, name).cameraids
+        need(
+            ints(ids) and all(0 <= i <= 3 for i in ids),
+            f"{name}.cameraids should be ints in 0-3",
+        )
+        need(getattr(cfg, name).max_age >= 0, f"{name}.max_age should be >= 0")
+        need(getattr(cfg, name).workers >= 1, f"{name}.workers should be >= 1")
+
+    need(cfg.marker.family in ("36h11",), f"unknown marker {cfg.marker.family}")
+    need(ints(cfg.marker.ids), "marker.ids should be ints")
+
+    od = cfg.objdet
+    need(0 < od.conf < 1 and 0 < od.iou < 1, "objdet.conf, objdet.iou in (0, 1)")
+    need(od.imgsz > 0 and od.imgsz % 32 == 0, "objdet.imgsz multiple of 32")
+    need(od.depth >= 1, "objdet.depth should be >= 1")
+    need(od.stats >= 0, "objdet.stats should be >= 0")
+
+    roi = cfg.roi
+    need(roi.n >= 1, "roi.n should be >= 1")
+    need(roi.size > 0 and roi.size % 2 == 0, "roi.size should be even")
+    need(roi.size <= min(cam.h, cam.w // 4), "roi.size larger than one camera")
+
+    ac = cfg.autoexp
+    need(ac.rate > 0 and ac.step >= 1, "autoexp.rate > 0, autoexp.step >= 1")
+    need(0 < ac.target < 255, "autoexp.target in (0, 255)")
+    need(ac.kp > 0, "autoexp.kp should be > 0")
+    for name in ("exposure", "gain"):
+        lim = getattr(ac, name)
+        need(
+            len(lim) == 2 and nums(lim) and 0 < lim[0] <= lim[1],
+            f"autoexp.{name} should be numbers [min, max]",
+        )
+
+    fps = cfg.FPS
+    need(len(fps.org) == 2 and ints(fps.org), "FPS.org should be ints [x, y]")
+    need(
+        len(fps.color) == 3 and ints(fps.color) and all(0 <= c <= 255 for c in fps.color),
+        "FPS.color should be ints [b, g, r] in 0-255",
+    )
+    need(fps.fontscale > 0 and fps.thickness >= 1, "FPS.fontscale > 0, FPS.thickness >= 1")
+
+
+def from_dict(d):
+    if not isinstance(d, dict):
+        raise ValueError("config: top level should be a mapping")
+    cfg = Config(**{f.name: _section(f.type, d.get(f.name), f.name) for f in fields(Config)})
+    _check(cfg)
+    return cfg
+
+
+def load_config(path):
+    with open(path, "r") as file:
+        try:
+            d = yaml.safe_load(file)
+        except yaml.YAMLError as e:
+            raise ValueError(f"config: {path}: {e}")
+    return from_dict(d)
+
+
+def merge_config(old, new):
+    # take the reloadable fields from new, report the rest as ignored
+    sections = {}
+    ignored = []
+    for f in fields(Config):
+        o, n = getattr(old, f.name), getattr(new, f.name)
+        safe = RELOADABLE.get(f.name, ())
+
+        kw = {}
+        for sf in fields(o):
+            ov, nv = getattr(o, sf.name), getattr(n, sf.name)
+            if ov == nv:
+                continue
+            if safe == "*" or sf.name in safe:
+                kw[sf.name] = nv
+            else:
+                ignored.append(f"{f.name}.{sf.name}")
+        sections[f.name] = replace(o, **kw)
+
+    return Config(**sections), ignored
+
+
+class LiveConfig(object):
+    """Current config as json in shared memory plus a version counter
+
+    The main process publish()es reloads, workers call poll() once per loop,
+    which is a single int compare unless the version moved.
+    """
+
+    SIZE = 1 << 16
+
+    def __init__(self, cfg):
+        self.shm = shared_memory.SharedMemory(create=True, size=LiveConfig.SIZE)
+        self.version = Value("L", 0)
+        self.publish(cfg)
+
+    def publish(self, cfg):
+        data = json.dumps(asdict(cfg)).encode()
+        if len(data) + 4 > LiveConfig.SIZE:
+            raise ValueError("config: too large for LiveConfig")
+
+        with self.version.get_lock():
+            self.shm.buf[:4] = len(data).to_bytes(4, "little")
+            self.shm.buf[4 : 4 + len(data)] = data
+            self.version.value += 1
+
+    def poll(self, cfg, version):
+        if self.version.value == version:
+            return cfg, version
+
+        with self.version.get_lock():
+            n = int.from_bytes(self.shm.buf[:4], "little")
+            data = bytes(self.shm.buf[4 : 4 + n])
+            version = self.version.value
+        return from_dict(json.loads(data)), version
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+if __name__ == "__main__":
+    # checks, python config.py
+    import copy
+    import os
+    import tempfile
+
+    d = asdict(load_config(os.path.join(os.path.dirname(__file__), "config.yaml")))
+    cfg = from_dict(d)
+
+    def rejects(edit):
+        bad = copy.deepcopy(d)
+        edit(bad)
+        try:
+            from_dict(bad)
+        except ValueError as e:
+            return str(e)
+        raise AssertionError("accepted")
+
+    assert "missing ['w']" in rejects(lambda b: b["camera"].pop("w"))
+    assert "unknown ['x']" in rejects(lambda b: b["roi"].update(x=1))
+    assert "should be a mapping" in rejects(lambda b: b.update(roi=[1]))
+    assert "roi.n should be int" in rejects(lambda b: b["roi"].update(n=2.0))
+    assert "roi.n should be int" in rejects(lambda b: b["roi"].update(n=True))
+    assert "cameraids" in rejects(lambda b: b["marker"].update(cameraids=["0"]))
+    assert "FPS.color" in rejects(lambda b: b["FPS"].update(color=[0, 0, 300]))
+    assert "roi.size" in rejects(lambda b: b["roi"].update(size=63))
+    assert "autoexp.gain" in rejects(lambda b: b["autoexp"].update(gain=[4, 1]))
+
+    # ints are taken for floats
+    ok = copy.deepcopy(d)
+    ok["objdet"]["stats"] = 2
+    assert from_dict(ok).objdet.stats == 2.0
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml") as f:
+        f.write("camera: [")
+        f.flush()
+        try:
+            load_config(f.name)
+            raise AssertionError("accepted")
+        except ValueError as e:
+            assert str(e).startswith(f"config: {f.name}"), e
+
+    # reloadable fields are taken, the rest reported and kept
+    new = copy.deepcopy(d)
+    new["camera"]["w"] += 2
+    new["marker"]["max_age"] += 1
+    new["display"]["main"] = not new["display"]["main"]
+    merged, ignored = merge_config(cfg, from_dict(new))
+    assert ignored == ["camera.w"], ignored
+    assert merged.camera.w == cfg.camera.w
+    assert merged.marker.max_age == cfg.marker.max_age + 1
+    assert merged.display.main != cfg.display.main
+    assert merge_config(cfg, cfg) == (cfg, [])
+
+    print("config checks ok")
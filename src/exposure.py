@@ -0,0 +1,203 @@
+import time
+
+import numpy as np
+
+from config import Autoexp
+
+
+# Exposure/gain control
+# runs in its own process at a few Hz, reads the published luma plane and
+# the marker detection rate, and sets the sensor controls through v4l2.
+
+
+def luma_stats(gray, step=8):
+    # mean, dark and saturated fractions of a decimated luma plane
+    if gray.ndim == 3:
+        gray = gray[::step, ::step, 1]  # green of BGR
+    else:
+        gray = gray[::step, ::step]
+
+    hist = np.bincount(gray.ravel(), minlength=256)
+    n = hist.sum()
+    mean = (hist * np.arange(256)).sum() / n
+    dark = hist[:8].sum() / n
+    sat = hist[248:].sum() / n
+    return mean, dark, sat
+
+
+class ExposureController(object):
+    """Proportional control of exposure * gain towards a target mean luma
+
+    Exposure is preferred over gain up to exp_cap. When the image is well
+    exposed but marker candidates rarely decode, motion blur is the likely
+    cause, so exp_cap is lowered while gain has room to make up the
+    difference. The cap relaxes again once decoding recovers, the image is
+    under target or gain is pinned.
+    """
+
+    def __init__(self, ac, exposure=None, gain=None):
+        self.exp_cap = ac.exposure[1]
+        self.configure(ac)
+        self.exposure = np.clip(exposure or self.exp_max, self.exp_min, self.exp_max)
+        self.gain = np.clip(gain or self.gain_min, self.gain_min, self.gain_max)
+
+    def configure(self, ac):
+        self.exp_min, self.exp_max = ac.exposure
+        self.gain_min, self.gain_max = ac.gain
+        self.target = ac.target
+        self.deadband = ac.deadband
+        self.kp = ac.kp
+        self.min_rate = ac.min_rate
+        self.exp_cap = np.clip(self.exp_cap, self.exp_min, self.exp_max)
+
+    def update(self, stats, rate=None):
+        mean, dark, sat = stats
+        settled = abs(mean - self.target) < self.deadband and sat < 0.05
+
+        # candidates seen but not decoded in a well exposed image: blur,
+        # shorten the exposure, but only while gain can make up for it
+        blur = rate is not None and rate < self.min_rate and settled
+        if blur and self.gain * 1.25 <= self.gain_max:
+            self.exp_cap = max(self.exp_cap * 0.8, self.exp_min)
+        elif not blur or self.gain >= self.gain_max:  # incl. under target
+            self.exp_cap = min(self.exp_cap * 1.25, self.exp_max)
+
+        ratio = 1.0
+        if not settled:
+            ratio = (self.target / max(mean, 1.0)) ** self.kp
+            if sat >= 0.05:
+                ratio = min(ratio, 0.8)  # clipped highlights hide the real mean
+            ratio = np.clip(ratio, 0.5, 2.0)
+
+        total = self.exposure * self.gain * ratio
+        self.exposure = np.clip(total / self.gain_min, self.exp_min, self.exp_cap)
+        self.gain = np.clip(total / self.exposure, self.gain_min, self.gain_max)
+
+        return int(round(self.exposure)), int(round(self.gain))
+
+
+class SimCamera(object):
+    # linear sensor looking at a textured scene, clipped to 8 bit
+    def __init__(self, scene=0.05, noise=2.0, shape=(400, 640), seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.texture = self.rng.uniform(0.2, 1.8, shape)
+        self.scene = scene
+        self.noise = noise
+
+    def capture(self, exposure, gain):
+        img = self.texture * self.scene * exposure * gain
+        img += self.rng.normal(0, self.noise * gain, img.shape)
+        return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def exposure_control(cfg, live, sframe, procid, quit, detrate=None):
+    import v4l2
+
+    from arducam_utils import ArducamUtils
+
+    shape = cfg.luma_shape if cfg.camera.luma else cfg.frame_shape
+
+    arducam_utils = ArducamUtils(cfg.camera.id)
+    exposure = arducam_utils.get_ctrl(v4l2.V4L2_CID_EXPOSURE)
+    gain = arducam_utils.get_ctrl(v4l2.V4L2_CID_GAIN)
+    ctrl = ExposureController(cfg.autoexp, exposure, gain)
+
+    seq = 0
+    version = live.version.value
+    while not quit.value:
+        time.sleep(1.0 / cfg.autoexp.rate)
+
+        new, version = live.poll(cfg, version)
+        if new is not cfg:
+            cfg = new
+            ctrl.configure(cfg.autoexp)
+
+        seq, frame = sframe.get(shape, seq)
+        if frame is None:
+            continue
+
+        rate = detrate.value if detrate is not None else None
+        if rate is not None and rate < 0:  # no evidence either way yet
+            rate = None
+        e, g = ctrl.update(luma_stats(frame, cfg.autoexp.step), rate)
+
+        if e != exposure:
+            arducam_utils.set_ctrl(v4l2.V4L2_CID_EXPOSURE, e)
+        if g != gain:
+            arducam_utils.set_ctrl(v4l2.V4L2_CID_GAIN, g)
+
+        if (e, g) != (exposure, gain):
+            print(f"autoexp {procid} exposure {e} gain {g} rate {rate}")
+            exposure, gain = e, g
+
+
+def run_sim(ctrl, sim, e, g, n, rate=None):
+    # n controller updates against sim, returns [(mean, exposure, gain)]
+    hist = []
+    for _ in range(n):
+        stats = luma_stats(sim.capture(e, g))
+        e, g = ctrl.update(stats, rate)
+        hist.append((stats[0], e, g))
+    return hist
+
+
+if __name__ == "__main__":
+    # checks against the simulated camera, python exposure.py
+    ac = Autoexp(
+        enable=True,
+        rate=2,
+        step=8,
+        target=110,
+        deadband=15,
+        kp=0.5,
+        exposure=[10, 2000],
+        gain=[1, 16],
+        min_rate=0.3,
+    )
+
+    def settled(hist, n=5):
+        return all(abs(m - ac.target) < ac.deadband for m, e, g in hist[-n:])
+
+    def bounded(hist):
+        return all(
+            ac.exposure[0] <= e <= ac.exposure[1] and ac.gain[0] <= g <= ac.gain[1]
+            for m, e, g in hist
+        )
+
+    # dark arena converges into the deadband
+    sim = SimCamera(scene=0.01)
+    ctrl = ExposureController(ac, 100, 1)
+    hist = run_sim(ctrl, sim, 100, 1, 30, rate=1.0)
+    assert settled(hist), hist[-5:]
+
+    # and recovers after the lights come up 8x
+    sim.scene *= 8
+    _, e, g = hist[-1]
+    hist = run_sim(ctrl, sim, e, g, 30, rate=1.0)
+    assert settled(hist), hist[-5:]
+    assert bounded(hist)
+
+    # no decodes in a reachable scene: exposure is traded for gain but the
+    # image stays on target and the controls stay in range
+    sim = SimCamera(scene=0.005)
+    ctrl = ExposureController(ac, 100, 1)
+    hist = run_sim(ctrl, sim, 100, 1, 200, rate=0.0)
+    assert settled(hist, 10), hist[-10:]
+    assert bounded(hist)
+    assert ctrl.exp_cap < ac.exposure[1]
+
+    # the cap comes back once markers decode again
+    _, e, g = hist[-1]
+    hist = run_sim(ctrl, sim, e, g, 40, rate=1.0)
+    assert ctrl.exp_cap == ac.exposure[1]
+    assert settled(hist), hist[-5:]
+
+    # too dark to reach the target: no decodes must not leave the image
+    # under exposed with the cap down, both controls end at their max
+    sim = SimCamera(scene=0.002)
+    ctrl = ExposureController(ac, 100, 1)
+    hist = run_sim(ctrl, sim, 100, 1, 200, rate=0.0)
+    assert bounded(hist)
+    assert hist[-1][1:] == (ac.exposure[1], ac.gain[1]), hist[-1]
+
+    print("exposure sim checks ok")
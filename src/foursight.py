@@ -1,17 +1,21 @@
+import os
 import signal
 import time
-from multiprocessing import Process, Semaphore, Value, shared_memory
+from multiprocessing import Array, Process, Queue, Semaphore, Value, shared_memory
 
 import cv2
 import numpy as np
-import yaml
 
 from arducam_utils import ArducamUtils
+from config import LiveConfig, load_config, merge_config
+from exposure import exposure_control
 from marker import marker_detect
+from merge import merge_results
 from objdet import object_detect
-from utils import fourcc, get_dim
+from utils import SharedFrame, SharedImages, fourcc, get_dim, get_rois
 
 quit = Value("i", 0)
+reload = Value("i", 0)
 
 
 def signal_handler(sig, frame):
@@ -20,46 +24,113 @@ def signal_handler(sig, frame):
     # sys.exit(0)
 
 
-def capture(cam, shm, sem, procid, quit):
+def reload_handler(sig, frame):
+    reload.value = 1
+
+
+def reload_config(cfg, live, path):
+    try:
+        new = load_config(path)
+    except (OSError, ValueError) as e:
+        print("config reload failed, keeping current config:", e)
+        return cfg
+
+    cfg, ignored = merge_config(cfg, new)
+    if ignored:
+        print("config reload: restart needed for", ", ".join(ignored))
+    live.publish(cfg)
+    print("config reloaded")
+    return cfg
+
+
+def publish_crops(frame, arducam_utils, crops, w, h, tw, th):
+    cs = crops["size"]
+    cw = w // 4  # one camera sensor width
+
+    out = []
+    for x, y in get_rois(crops["rois"]):
+        # resized -> sensor pixels, kept inside one camera and even aligned
+        # so the crop starts on the same bayer phase as the frame
+        fx, fy = int(x * w / tw), int(y * h / th)
+        c0 = min(fx // cw, 3) * cw
+        x0 = min(max(fx - cs // 2, c0), c0 + cw - cs) & ~1
+        y0 = min(max(fy - cs // 2, 0), h - cs) & ~1
+
+        crop = np.ascontiguousarray(frame[y0 : y0 + cs, x0 : x0 + cs])
+        crop = arducam_utils.convert(crop)
+        if crop.ndim == 3:
+            crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+        out.append((x0, y0, crop))
+
+    origins = crops["origins"]
+    crops["sem"].acquire()
+    crop_array = np.ndarray(
+        shape=(len(origins) // 3, cs, cs), dtype=np.uint8, buffer=crops["shm"].buf
+    )
+    for k in range(len(origins) // 3):
+        if k < len(out):
+            x0, y0, crop = out[k]
+            np.copyto(crop_array[k], crop)
+            origins[3 * k : 3 * k + 3] = [1, x0, y0]
+        else:
+            origins[3 * k] = 0
+    crops["seq"].value += 1
+    crops["sem"].release()
+
+
+def capture(cfg, live, sframe, procid, quit, sluma=None, crops=None):
     win_name = f"main {procid}"
-    pixelformat = fourcc(cam["pformat"])
+    cam = cfg.camera
+    pixelformat = fourcc(cam.pformat)
 
-    cap = cv2.VideoCapture(cam["id"], cv2.CAP_V4L2)
+    cap = cv2.VideoCapture(cam.id, cv2.CAP_V4L2)
     cap.set(cv2.CAP_PROP_FOURCC, pixelformat)
 
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, cam["w"])
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, cam["h"])
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, cam.w)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, cam.h)
 
     w = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
     h = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
     h = int(h)
     w = int(w)
 
-    arducam_utils = ArducamUtils(cam["id"])
+    arducam_utils = ArducamUtils(cam.id)
     cap.set(cv2.CAP_PROP_CONVERT_RGB, arducam_utils.convert2rgb)
     arducam_utils.write_dev(ArducamUtils.CHANNEL_SWITCH_REG, -1)
 
     # Turn off auto exposure
     # cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)
-    # set exposure time
-    cap.set(cv2.CAP_PROP_EXPOSURE, -4)
+    # set exposure time, the autoexp process owns it when enabled
+    if not cfg.autoexp.enable:
+        cap.set(cv2.CAP_PROP_EXPOSURE, -4)
 
     p_tm = time.time()
-    tw, th = get_dim(w, h, cam["wr"])
+    tw, th = get_dim(w, h, cam.wr)
+    version = live.version.value
 
     while cap.isOpened():
         ret, frame = cap.read()
-        sem.acquire()
+        tm = time.time()
+        cfg, version = live.poll(cfg, version)
 
         frame = frame.reshape(h, w)
+
+        if sluma is not None:
+            # luma plane straight from the raw frame, before debayer
+            gray = arducam_utils.luma(frame)
+            if gray.shape != (th, tw):
+                gray = cv2.resize(gray, (tw, th))
+            sluma.put(gray, tm)
+
+        if crops is not None:
+            # full resolution crops from the raw frame, only where asked
+            publish_crops(frame, arducam_utils, crops, w, h, tw, th)
+
         frame = arducam_utils.convert(frame)
         frame = cv2.resize(frame, (tw, th))
+        sframe.put(frame, tm)
 
-        shm_array = np.ndarray(shape=frame.shape, dtype=np.uint8, buffer=shm.buf)
-        np.copyto(shm_array, frame)
-        sem.release()
-
-        if cfg["display"]["main"]:
+        if cfg.display.main:
             now = time.time()
             fps = f"FPS {1/(now-p_tm):.1f}"
             p_tm = now
@@ -67,11 +138,11 @@ def capture(cam, shm, sem, procid, quit):
             frame = cv2.putText(
                 frame,
                 fps,
-                cfg["FPS"]["org"],
+                cfg.FPS.org,
                 cv2.FONT_HERSHEY_SIMPLEX,
-                cfg["FPS"]["fontscale"],
-                cfg["FPS"]["color"],
-                cfg["FPS"]["thickness"],
+                cfg.FPS.fontscale,
+                cfg.FPS.color,
+                cfg.FPS.thickness,
                 cv2.LINE_AA,
             )
             cv2.imshow(win_name, frame)
@@ -90,36 +161,127 @@ def capture(cam, shm, sem, procid, quit):
 if __name__ == "__main__":
 
     signal.signal(signal.SIGINT, signal_handler)
-
-    with open("config.yaml", "r") as file:
-        cfg = yaml.safe_load(file)
-
-    cam = cfg["camera"]
-
-    tw, th = get_dim(cam["w"], cam["h"], cam["wr"])
-    shm_sz = tw * th * cam["c"]  # 3 channel BGR
-
-    shm = shared_memory.SharedMemory(create=True, size=shm_sz)
-    sem = Semaphore(1)
-
-    proc_cap = Process(target=capture, args=(cam, shm, sem, 0, quit))
+    signal.signal(signal.SIGHUP, reload_handler)
+
+    cfg_path = "config.yaml"
+    cfg = load_config(cfg_path)
+    cfg_mtime = os.stat(cfg_path).st_mtime
+    live = LiveConfig(cfg)
+
+    cam = cfg.camera
+
+    # ring slots, one per worker striping the buffer and one for put()
+    nmarker = cfg.marker.workers if cfg.tasks.marker else 1
+    nobjdet = cfg.objdet.workers if cfg.tasks.objdet else 1
+
+    tw, th = cfg.dim
+    slots = max(nobjdet, 1 if cam.luma else nmarker) + 1
+    sframe = SharedFrame(tw * th * cam.c, slots)  # 3 channel BGR
+
+    # single channel luma plane for the marker path
+    sluma = None
+    if cam.luma:
+        sluma = SharedFrame(tw * th, nmarker + 1)
+
+    # full resolution crops around regions the marker process asks for
+    crops = None
+    if cfg.roi.enable:
+        n, cs = cfg.roi.n, cfg.roi.size
+        crops = {
+            "size": cs,
+            "rois": Array("i", n * 3),
+            "origins": Array("i", n * 3, lock=False),
+            "seq": Value("L", 0, lock=False),  # crop sets published
+            "taken": Value("L", 0, lock=False),  # last set a worker took
+            "shm": shared_memory.SharedMemory(create=True, size=n * cs * cs),
+            "sem": Semaphore(1),
+        }
+
+    procs = []
+    proc_cap = Process(
+        target=capture, args=(cfg, live, sframe, 0, quit, sluma, crops)
+    )
     proc_cap.start()
 
-    if cfg["tasks"]["marker"]:
-        proc_marker = Process(target=marker_detect, args=(cfg, shm, sem, 1, quit))
-        proc_marker.start()
-
-    if cfg["tasks"]["objdet"]:
-        proc_objdet = Process(target=object_detect, args=(cfg, shm, sem, 2, quit))
-        proc_objdet.start()
-
-    proc_cap.join()
-
-    if cfg["tasks"]["marker"]:
-        proc_marker.join()
-
-    if cfg["tasks"]["objdet"]:
-        proc_objdet.join()
-
-    shm.close()
-    shm.unlink()
+    # fraction of marker frames with candidates that decoded, feeds autoexp
+    detrate = Value("d", -1.0)  # unknown until markers are seen
+
+    # each task is a pool of workers striping frames by seq, and a merge
+    # process putting their results back in order. A pool hands its display
+    # images over in shared memory, a few slots per worker so one is still
+    # there when the merge stage releases its result
+    images = []
+    procid = 1
+    if cfg.tasks.marker:
+        results = Queue()
+        marker_src = sluma if cam.luma else sframe
+        mimages = None
+        if nmarker > 1:
+            mimages = SharedImages(tw * th * 3, 4 * nmarker)
+            images.append(mimages)
+        for k in range(nmarker):
+            stripe = (k, nmarker)
+            args = (cfg, live, marker_src, procid, quit, results, stripe, crops)
+            kwargs = {"images": mimages}
+            procs.append(Process(target=marker_detect, args=args, kwargs=kwargs))
+            procid += 1
+
+        args = (cfg, live, "marker", results, nmarker, procid, quit)
+        kwargs = {"detrate": detrate, "crops": crops, "images": mimages}
+        procs.append(Process(target=merge_results, args=args, kwargs=kwargs))
+        procid += 1
+
+    if cfg.tasks.objdet:
+        results = Queue()
+        oimages = None
+        if nobjdet > 1:
+            oimages = SharedImages(tw * th * 3, 4 * nobjdet)
+            images.append(oimages)
+        for k in range(nobjdet):
+            stripe = (k, nobjdet)
+            args = (cfg, live, sframe, procid, quit, results, stripe)
+            kwargs = {"images": oimages}
+            procs.append(Process(target=object_detect, args=args, kwargs=kwargs))
+            procid += 1
+
+        args = (cfg, live, "objdet", results, nobjdet, procid, quit)
+        kwargs = {"images": oimages}
+        procs.append(Process(target=merge_results, args=args, kwargs=kwargs))
+        procid += 1
+
+    if cfg.autoexp.enable:
+        rate = detrate if cfg.tasks.marker else None
+        args = (cfg, live, sluma if cam.luma else sframe, procid, quit, rate)
+        procs.append(Process(target=exposure_control, args=args))
+
+    for p in procs:
+        p.start()
+
+    # reload on SIGHUP or when config.yaml changes
+    while proc_cap.is_alive():
+        proc_cap.join(0.5)
+
+        try:
+            mtime = os.stat(cfg_path).st_mtime
+        except OSError:
+            mtime = cfg_mtime
+        if reload.value or mtime != cfg_mtime:
+            reload.value = 0
+            cfg_mtime = mtime
+            cfg = reload_config(cfg, live, cfg_path)
+
+    for p in procs:
+        p.join()
+
+    sframe.close()
+    live.close()
+
+    if sluma is not None:
+        sluma.close()
+
+    if crops is not None:
+        crops["shm"].close()
+        crops["shm"].unlink()
+
+    for im in images:
+        im.close()
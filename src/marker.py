@@ -1,23 +1,45 @@
 import time
+from collections import deque
 
 import cv2
 import numpy as np
 
-from utils import get_dim, get_shm_frame
+from merge import show
+from utils import get_shm_crops
 
 
-def marker_detect(cfg, shm, sem, procid, quit):
+def near_tag(c, tags):
+    # candidate within about a tag size of a tag decoded in the last frames
+    x, y = c.mean(0)
+    return any(
+        abs(x - tx) < 1.5 * side and abs(y - ty) < 1.5 * side
+        for tx, ty, side in tags
+    )
 
-    win_name = f"marker det {procid}"
-    cam = cfg["camera"]
-    mark = cfg["marker"]
 
-    tw, th = get_dim(cam["w"], cam["h"], cam["wr"])
+def marker_detect(
+    cfg,
+    live,
+    sframe,
+    procid,
+    quit,
+    results,
+    stripe=(0, 1),
+    crops=None,
+    images=None,
+):
+    win_name = f"marker {procid}"
 
-    if mark["family"] == "36h11":
+    k = stripe[0]  # worker index in the pool
+    cam = cfg.camera
+
+    tw, th = cfg.dim
+
+    if cfg.marker.family == "36h11":
         marker_dict = cv2.aruco.DICT_APRILTAG_36h11
     else:
-        print("unknown marker", mark["family"])
+        print("unknown marker", cfg.marker.family)
+        results.put(("done", k, 0, None))
         return
 
     dictionary = cv2.aruco.getPredefinedDictionary(marker_dict)
@@ -25,18 +47,41 @@ def marker_detect(cfg, shm, sem, procid, quit):
     detector = cv2.aruco.ArucoDetector(dictionary, detectorparams)
 
     # the 4 cameras are combined into a wide image 400x2560
-    imw = cfg["camera"]["wr"] // 4  # one camera width
+    imw = cfg.imw  # one camera width
+
+    # luma plane is single channel
+    shape = cfg.luma_shape if cam.luma else cfg.frame_shape
+
+    s = tw / cam.w  # sensor -> resized scale
+
+    seen = {}  # per camera, (cx, cy, side) of tags decoded in the last frames
 
     p_tm = time.time()
+    seq = 0
+    version = live.version.value
     while True:
-        frame = get_shm_frame(shm, sem, (th, tw, cam["c"]))
+        cfg, version = live.poll(cfg, version)
+        display = cfg.display.marker
+
+        # sleep until capture has a new frame, skip stale ones
+        seq, frame = sframe.get(shape, seq, cfg.marker.max_age, stripe)
+        if frame is None:
+            if quit.value:
+                break
+            continue
+
         frames = {}
         markers = {}
+        want = []  # crop centers to ask capture for
+        nrej = 0  # candidates where a tag decoded lately, likely blurred
 
         # Do imarker detection only cameras specified in cfg
-        for i in cfg["marker"]["cameraids"]:
-            framei = frame[:, i * imw : (i + 1) * imw, :]
+        for i in cfg.marker.cameraids:
+            framei = frame[:, i * imw : (i + 1) * imw]
             corners, markerids, rejects = detector.detectMarkers(framei)
+
+            if display and framei.ndim == 2:
+                framei = cv2.cvtColor(framei, cv2.COLOR_GRAY2BGR)
             markers[i] = []
 
             # Calculate and draw center point
@@ -47,36 +92,74 @@ def marker_detect(cfg, shm, sem, procid, quit):
                     cy = int(c[:, 1].sum() / 4)
                     markers[i].append((id, cx, cy))
 
-                if cfg["display"]["marker"]:
+                if display:
                     cv2.circle(framei, (cx, cy), 4, (0, 0, 255), -1)
 
-            if cfg["display"]["marker"]:
+            if display:
                 cv2.aruco.drawDetectedMarkers(framei, corners, markerids)
                 frames[i] = framei
 
-        if cfg["display"]["marker"]:
+            # decoded tags need no crop, and the inner quads aruco rejects
+            # inside them are not candidates of their own
+            tags = []
+            boxes = []
+            for c in corners:
+                c = c.squeeze()
+                tags.append((*c.mean(0), np.linalg.norm(c[0] - c[1])))
+                boxes.append((c.min(0), c.max(0)))
+
+            # small undecoded candidates are likely far tags. aruco rejects
+            # plenty of plain quads, a large one only says blur where a tag
+            # decoded in the last few frames
+            recent = seen.setdefault(i, deque(maxlen=5))
+            near = [t for f in recent for t in f]
+            for c in rejects:
+                c = c.squeeze()
+                m = c.mean(0)
+                if any((lo <= m).all() and (m <= hi).all() for lo, hi in boxes):
+                    continue
+                if np.linalg.norm(c[0] - c[1]) < cfg.roi.minside:
+                    want.append((i * imw + m[0], m[1]))
+                elif near_tag(c, near):
+                    nrej += 1
+            recent.append(tags)
+
+        if crops is not None:
+            # crops were cut from an earlier frame, with the rois the
+            # merge stage asked for from the pool's recent results
+            for x0, y0, crop in get_shm_crops(crops):
+                corners, markerids, rejects = detector.detectMarkers(crop)
+                if markerids is None:
+                    continue
+
+                i = int(x0 * s) // imw
+                # a crop can still overlap a tag the full frame decoded
+                known = {int(m[0][0]) for m in markers.setdefault(i, [])}
+                for c, id in zip(corners, markerids):
+                    if int(id[0]) in known:
+                        continue
+                    c = c.squeeze()
+                    cx = int((x0 + c[:, 0].mean()) * s) - i * imw
+                    cy = int((y0 + c[:, 1].mean()) * s)
+                    markers[i].append((id, cx, cy))
+
+                    if display and i in frames:
+                        cv2.circle(frames[i], (cx, cy), 4, (0, 255, 0), -1)
+
+        # a pool leaves its image for the merge stage, a single worker
+        # shows it here
+        if display and frames:
             iframe = np.hstack(list(frames.values()))
+            if images is None:
+                p_tm = show(cfg, win_name, iframe, p_tm, quit)
+            else:
+                images.put(seq, iframe)
 
-            now = time.time()
-            fps = f"FPS {1/(now-p_tm):.1f}"
-            p_tm = now
-
-            frame = cv2.putText(
-                iframe,
-                fps,
-                cfg["FPS"]["org"],
-                cv2.FONT_HERSHEY_SIMPLEX,
-                cfg["FPS"]["fontscale"],
-                cfg["FPS"]["color"],
-                cfg["FPS"]["thickness"],
-                cv2.LINE_AA,
-            )
-
-            cv2.imshow(win_name, frame)
-
-            if cv2.waitKey(1) == 27:
-                quit.value = 1
-                break
+        # merge_results puts the pool's results back in order
+        payload = {"markers": markers, "rejects": nrej, "want": want}
+        results.put(("res", k, seq, payload))
 
         if quit.value:
             break
+
+    results.put(("done", k, 0, None))
@@ -0,0 +1,196 @@
+import heapq
+import queue
+import time
+from collections import deque
+
+import cv2
+
+from utils import set_rois
+
+
+# Merge stage of a worker pool
+# workers put ("res", k, seq, payload) and finally ("done", k, 0, None) on a
+# multiprocessing Queue. Each worker takes its frames in increasing seq, so
+# once every worker has reported past seq nothing older can still arrive and
+# the result is released in order.
+# Display images stay out of the queue, a pool leaves them in SharedImages
+# for the merge stage to show, a single worker shows its own.
+
+HOLD = 0.25  # seconds a result waits on a stalled worker
+STALE = 1.0  # seconds without blur evidence before detrate goes unknown
+
+
+def merge_rois(recent, dist):
+    # newest first, drop points within dist of one already taken
+    pts = []
+    for want in reversed(recent):
+        for x, y in want:
+            if all(abs(x - px) > dist or abs(y - py) > dist for px, py in pts):
+                pts.append((x, y))
+    return pts
+
+
+def show(cfg, win_name, img, p_tm, quit):
+    # FPS overlay and imshow, returns the time of this frame
+    now = time.time()
+    fps = f"FPS {1/(now-p_tm):.1f}"
+
+    img = cv2.putText(
+        img,
+        fps,
+        cfg.FPS.org,
+        cv2.FONT_HERSHEY_SIMPLEX,
+        cfg.FPS.fontscale,
+        cfg.FPS.color,
+        cfg.FPS.thickness,
+        cv2.LINE_AA,
+    )
+    cv2.imshow(win_name, img)
+
+    if cv2.waitKey(1) == 27:
+        quit.value = 1
+    return now
+
+
+def merge_results(
+    cfg,
+    live,
+    task,
+    results,
+    nworkers,
+    procid,
+    quit,
+    detrate=None,
+    crops=None,
+    images=None,
+):
+    win_name = f"{task} {procid}"
+
+    last = [0] * nworkers  # last seq reported by each worker
+    recent = deque(maxlen=nworkers)  # roi requests, one result per stripe
+    heap = []
+    emitted = 0
+    evidence = time.time()  # last result that said anything about blur
+
+    p_tm = time.time()
+    idle = 0
+    version = live.version.value
+    while min(last) != float("inf"):
+        cfg, version = live.poll(cfg, version)
+
+        # keep draining after quit so workers can flush their queue and
+        # exit, give up after a second of silence
+        try:
+            kind, k, seq, payload = results.get(timeout=0.1)
+            idle = 0
+        except queue.Empty:
+            idle += 1
+            if quit.value and idle >= 10:
+                break
+            kind = None
+
+        if kind == "done":
+            last[k] = float("inf")  # done workers don't hold anything back
+        elif kind == "res":
+            last[k] = seq
+            if seq > emitted:  # late after a HOLD release, drop it
+                heapq.heappush(heap, (seq, time.time(), payload))
+
+        now = time.time()
+        while heap and (heap[0][0] <= min(last) or now - heap[0][1] > HOLD):
+            seq, _, payload = heapq.heappop(heap)
+            emitted = seq
+
+            # smoothed marker decode rate for the exposure controller,
+            # frames without any near candidate say nothing about blur and
+            # after STALE of those the rate is unknown (-1)
+            if detrate is not None:
+                hit = any(len(m) for m in payload["markers"].values())
+                if hit or payload["rejects"]:
+                    evidence = now
+                    if detrate.value < 0:
+                        detrate.value = float(hit)
+                    else:
+                        detrate.value = 0.9 * detrate.value + 0.1 * hit
+                elif now - evidence > STALE:
+                    detrate.value = -1.0
+
+            # one roi array for the whole pool, fed from the last result of
+            # each worker so a frame without candidates doesn't clear the
+            # others' requests
+            if crops is not None:
+                recent.append(payload["want"])
+                dist = crops["size"] * cfg.camera.wr / cfg.camera.w / 2
+                set_rois(crops["rois"], merge_rois(recent, dist))
+
+            if getattr(cfg.display, task) and images is not None:
+                img = images.get(seq)
+                if img is not None:
+                    p_tm = show(cfg, win_name, img, p_tm, quit)
+
+    cv2.destroyAllWindows()
+
+
+if __name__ == "__main__":
+    # checks, python merge.py
+    import threading
+    from types import SimpleNamespace
+
+    import numpy as np
+
+    from utils import SharedImages
+
+    class Live(object):
+        version = SimpleNamespace(value=0)
+
+        def poll(self, cfg, version):
+            return cfg, version
+
+    # released results are recorded through their display image
+    shown = []
+
+    def show(cfg, win_name, img, p_tm, quit):
+        shown.append(int(img[0, 0, 0]))
+        return p_tm
+
+    cv2.destroyAllWindows = lambda: None  # headless opencv has no highgui
+
+    cfg = SimpleNamespace(display=SimpleNamespace(objdet=True))
+    images = SharedImages(3, 16)
+
+    def run(msgs, late=(), quit=0):
+        # msgs now, late after two HOLDs, returns the seqs shown in order
+        shown.clear()
+        results = queue.Queue()
+        for k, seq in list(msgs) + list(late):
+            if seq:
+                images.put(seq, np.full((1, 1, 3), seq, dtype=np.uint8))
+        for k, seq in msgs:
+            results.put(("res", k, seq, {}) if seq else ("done", k, 0, None))
+
+        def feed():
+            time.sleep(2 * HOLD)
+            for k, seq in late:
+                results.put(("res", k, seq, {}) if seq else ("done", k, 0, None))
+
+        threading.Thread(target=feed, daemon=True).start()
+        q = SimpleNamespace(value=quit)
+        merge_results(cfg, Live(), "objdet", results, 2, 0, q, images=images)
+        return shown[:]
+
+    # out of order across workers, released in seq order
+    msgs = [(0, 2), (0, 4), (1, 1), (0, 6), (1, 3), (1, 5), (0, 0), (1, 0)]
+    assert run(msgs) == [1, 2, 3, 4, 5, 6], shown
+
+    # worker 1 stalls, 0's results go after HOLD and 1's are late
+    t = time.time()
+    assert run([(0, 2), (0, 4), (0, 0)], [(1, 1), (1, 3), (1, 0)]) == [2, 4]
+    assert time.time() - t > 2 * HOLD
+
+    # after quit a silent worker is given up on once the queue drains
+    t = time.time()
+    assert run([(0, 1)], quit=1) == [1], shown
+    assert time.time() - t < 2
+
+    images.close()
+    print("merge checks ok")
@@ -1,63 +1,85 @@
 import time
 
-import cv2
 import numpy as np
-from ultralytics import YOLO
 
-from utils import get_dim, get_shm_frame
+from merge import show
+from pipeline import Pipeline, draw_dets, get_backend
 
 
-def object_detect(cfg, shm, sem, procid, quit):
+def object_detect(
+    cfg, live, sframe, procid, quit, results, stripe=(0, 1), images=None
+):
     win_name = f"obj det {procid}"
 
-    cam = cfg["camera"]
-    tw, th = get_dim(cam["w"], cam["h"], cam["wr"])
+    k = stripe[0]  # worker index in the pool
+    od = cfg.objdet
 
-    trt_model = YOLO("yolo11n.engine", task="detect")
+    backend = get_backend(od.model)
+    pipe = Pipeline(backend, od.imgsz, od.conf, od.iou, od.depth)
 
     # the 4 cameras are combined into a wide image 400x2560
-    imw = cfg["camera"]["wr"] // 4  # one camera width
+    imw = cfg.imw  # one camera width
 
-    p_tm = time.time()
+    s_tm = time.time()
+    p_tm = s_tm
+    seq = 0
+    version = live.version.value
+    pending = None  # frame in flight in the pipeline, and its cameras
 
     while True:
 
-        frame = get_shm_frame(shm, sem, (th, tw, cam["c"]))  # hwc 400, 2560, 3
-        results = {}
+        cfg, version = live.poll(cfg, version)
+        od = cfg.objdet
+        pipe.conf, pipe.iou = od.conf, od.iou
 
-        # Do object detection only cameras specified in cfg
-        for i in cfg["objdet"]["cameraids"]:
-            framei = frame[:, i * imw : (i + 1) * imw, :]
-            res = trt_model.predict(framei, verbose=False)
-            results[i] = res
-
-        if cfg["display"]["objdet"]:
-            frames = []
-            for i, res in results.items():
-                for r in res:
-                    frames.append(r.plot())
-
-            iframe = np.hstack(frames)
-
-            now = time.time()
-            fps = f"FPS {1/(now-p_tm):.1f}"
-            p_tm = now
-
-            frame = cv2.putText(
-                iframe,
-                fps,
-                cfg["FPS"]["org"],
-                cv2.FONT_HERSHEY_SIMPLEX,
-                cfg["FPS"]["fontscale"],
-                cfg["FPS"]["color"],
-                cfg["FPS"]["thickness"],
-                cv2.LINE_AA,
-            )
-            cv2.imshow(win_name, frame)
-
-            if cv2.waitKey(1) == 27:
-                quit.value = 1
+        # sleep until capture has a new frame, skip stale ones
+        # hwc 400, 2560, 3
+        seq, frame = sframe.get(cfg.frame_shape, seq, od.max_age, stripe)
+        if frame is None:
+            if quit.value:
                 break
+            continue
+
+        # Do object detection only cameras specified in cfg
+        # queue this frame before collecting the previous one so the
+        # pipeline stages overlap
+        cameraids = list(od.cameraids)
+        for i in cameraids:
+            pipe.put((seq, i), frame[:, i * imw : (i + 1) * imw, :])
+
+        if pending is not None:
+            pseq, pframe, pids = pending
+            dets = {}
+            for _ in pids:
+                (s, i), d = pipe.get()
+                dets[i] = d
+
+            # a pool leaves its image for the merge stage, a single worker
+            # shows it here
+            if cfg.display.objdet and dets:
+                frames = []
+                for i, d in dets.items():
+                    framei = pframe[:, i * imw : (i + 1) * imw, :]
+                    frames.append(draw_dets(framei, d, backend.names))
+                iframe = np.hstack(frames)
+                if images is None:
+                    p_tm = show(cfg, win_name, iframe, p_tm, quit)
+                else:
+                    images.put(pseq, iframe)
+
+            # merge_results puts the pool's results back in order
+            results.put(("res", k, pseq, dets))
+
+        pending = (seq, frame, cameraids)
+
+        # per stage busy fraction over the last interval
+        if od.stats and time.time() - s_tm > od.stats:
+            s_tm = time.time()
+            util = pipe.utilization()
+            print(win_name, " ".join(f"{n} {v:.0%}" for n, v in util.items()))
 
         if quit.value:
             break
+
+    pipe.close()
+    results.put(("done", k, 0, None))
@@ -0,0 +1,343 @@
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+# Pipelined YOLO inference
+# preprocess -> infer -> postprocess each run in their own thread, connected
+# by bounded queues, so frame N+1 is letterboxed while frame N is on the
+# accelerator and frame N-1 goes through NMS.
+# cv2, numpy and the inference backends release the GIL for the heavy work.
+
+
+def letterbox(img, size):
+    h, w = img.shape[:2]
+    r = min(size / h, size / w)
+    nw, nh = int(round(w * r)), int(round(h * r))
+
+    img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    top = (size - nh) // 2
+    left = (size - nw) // 2
+    img = cv2.copyMakeBorder(
+        img,
+        top,
+        size - nh - top,
+        left,
+        size - nw - left,
+        cv2.BORDER_CONSTANT,
+        value=(114, 114, 114),
+    )
+    return img, r, (left, top)
+
+
+class CpuBackend(object):
+    # ONNX model through opencv dnn, runs anywhere
+    def __init__(self, path):
+        self.net = cv2.dnn.readNet(path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.names = {}
+
+    def __call__(self, blob):
+        self.net.setInput(blob)
+        return self.net.forward()
+
+
+class TrtBackend(object):
+    # TensorRT engine through ultralytics AutoBackend
+    def __init__(self, path):
+        import torch
+        from ultralytics.nn.autobackend import AutoBackend
+
+        self.torch = torch
+        self.device = torch.device("cuda:0")
+        self.model = AutoBackend(path, device=self.device)
+        self.names = self.model.names
+
+    def __call__(self, blob):
+        im = self.torch.from_numpy(blob).to(self.device)
+        y = self.model(im)
+        if isinstance(y, (list, tuple)):
+            y = y[0]
+        return y.float().cpu().numpy()
+
+
+def get_backend(path):
+    if path.endswith(".engine"):
+        return TrtBackend(path)
+    return CpuBackend(path)
+
+
+class Stage(threading.Thread):
+    def __init__(self, name, fn, qin, qout):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.qin = qin
+        self.qout = qout
+        self.busy = 0.0
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            item = self.qin.get()
+            if item is None:  # shutdown, pass it down the line
+                self.qout.put(None)
+                break
+
+            tag, data = item
+            t = time.perf_counter()
+            out = self.fn(data)
+            with self.lock:
+                self.busy += time.perf_counter() - t
+            self.qout.put((tag, out))
+
+    def utilization(self):
+        # busy fraction since the last call
+        now = time.perf_counter()
+        with self.lock:
+            busy, self.busy = self.busy, 0.0
+            t0, self.t0 = self.t0, now
+        return busy / (now - t0)
+
+
+class Pipeline(object):
+    """Three stage YOLO detection pipeline
+
+    put(tag, img) queues an image, get() returns (tag, dets) in the same
+    order. dets is an Nx6 array of x1, y1, x2, y2, conf, cls in image pixels.
+    Stage queues are bounded by depth, put() blocks while the accelerator is
+    behind.
+    """
+
+    def __init__(self, backend, imgsz=640, conf=0.25, iou=0.45, depth=2):
+        self.backend = backend
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+
+        # output is unbounded so a caller queueing a whole frame ahead
+        # never deadlocks against its own results
+        qs = [queue.Queue(maxsize=depth) for _ in range(3)] + [queue.Queue()]
+        self.qin = qs[0]
+        self.qout = qs[-1]
+
+        self.stages = [
+            Stage("preprocess", self.preprocess, qs[0], qs[1]),
+            Stage("infer", self.infer, qs[1], qs[2]),
+            Stage("postprocess", self.postprocess, qs[2], qs[3]),
+        ]
+        for s in self.stages:
+            s.start()
+
+    def preprocess(self, img):
+        lb, r, pad = letterbox(img, self.imgsz)
+        blob = cv2.dnn.blobFromImage(lb, 1 / 255.0, swapRB=True)  # NCHW float32
+        return blob, (r, pad)
+
+    def infer(self, data):
+        blob, meta = data
+        return self.backend(blob), meta
+
+    def postprocess(self, data):
+        preds, (r, (left, top)) = data
+
+        p = np.squeeze(preds, 0).T  # N x (4 + classes)
+        scores = p[:, 4:]
+        cls = scores.argmax(1)
+        conf = scores[np.arange(len(p)), cls]
+
+        keep = conf > self.conf
+        p, cls, conf = p[keep], cls[keep], conf[keep]
+        if not len(p):
+            return np.zeros((0, 6), dtype=np.float32)
+
+        # cx, cy, w, h in letterbox pixels -> x, y, w, h in image pixels
+        boxes = np.empty((len(p), 4), dtype=np.float32)
+        boxes[:, 0] = (p[:, 0] - p[:, 2] / 2 - left) / r
+        boxes[:, 1] = (p[:, 1] - p[:, 3] / 2 - top) / r
+        boxes[:, 2] = p[:, 2] / r
+        boxes[:, 3] = p[:, 3] / r
+
+        # per class, a person in front of a robot keeps both boxes
+        idx = cv2.dnn.NMSBoxesBatched(
+            boxes.tolist(), conf.tolist(), cls.tolist(), self.conf, self.iou
+        )
+        idx = np.array(idx, dtype=int).reshape(-1)
+
+        dets = np.empty((len(idx), 6), dtype=np.float32)
+        dets[:, :2] = boxes[idx, :2]
+        dets[:, 2:4] = boxes[idx, :2] + boxes[idx, 2:]
+        dets[:, 4] = conf[idx]
+        dets[:, 5] = cls[idx]
+        return dets
+
+    def put(self, tag, img):
+        self.qin.put((tag, img))
+
+    def get(self):
+        return self.qout.get()
+
+    def close(self):
+        # keep draining so a full pipeline can take the shutdown item
+        while True:
+            try:
+                self.qin.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                while not self.qout.empty():
+                    self.qout.get_nowait()
+
+        while self.qout.get() is not None:
+            pass
+        for s in self.stages:
+            s.join()
+
+    def utilization(self):
+        return {s.name: s.utilization() for s in self.stages}
+
+
+def draw_dets(img, dets, names):
+    for x1, y1, x2, y2, conf, cls in dets:
+        x1, y1, x2, y2, cls = int(x1), int(y1), int(x2), int(y2), int(cls)
+        txt = f"{names.get(cls, cls)} {conf:.2f}"
+
+        cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 255), 1)
+        cv2.putText(
+            img, txt, (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 1
+        )
+    return img
+
+
+class StubBackend(object):
+    # fixed YOLO style output (1, 84, N), for checks without a model
+    def __init__(self, preds, delay=0.0):
+        self.preds = preds
+        self.delay = delay
+        self.names = {}
+
+    def __call__(self, blob):
+        time.sleep(self.delay)
+        return self.preds
+
+
+def const_onnx(path, preds, imgsz=640):
+    # ONNX model whose output is preds for any image, for checking
+    # CpuBackend without a model file. Hand encoded protobuf, onnx itself
+    # is not a dependency.
+    def varint(n):
+        out = b""
+        while n > 0x7F:
+            out += bytes([n & 0x7F | 0x80])
+            n >>= 7
+        return out + bytes([n])
+
+    def vi(f, n):  # varint field
+        return varint(f << 3) + varint(n)
+
+    def ld(f, b):  # length delimited field
+        b = b.encode() if isinstance(b, str) else b
+        return varint(f << 3 | 2) + varint(len(b)) + b
+
+    def tensor(name, a):
+        dt = {np.float32: 1, np.int64: 7}[a.dtype.type]
+        dims = b"".join(vi(1, d) for d in a.shape)
+        return dims + vi(2, dt) + ld(8, name) + ld(9, a.tobytes())
+
+    def value_info(name, shape):
+        dims = b"".join(ld(1, vi(1, d)) for d in shape)
+        return ld(1, name) + ld(2, ld(1, vi(1, 1) + ld(2, dims)))
+
+    def node(op, ins, outs, attrs=b""):
+        io = b"".join(ld(1, i) for i in ins) + b"".join(ld(2, o) for o in outs)
+        return ld(1, io + ld(4, op) + attrs)
+
+    # output0 = mean(images) * 0 + preds, so the input is still used
+    axes = ld(5, ld(1, "axes") + b"".join(vi(8, a) for a in (1, 2, 3)) + vi(20, 7))
+    keep = ld(5, ld(1, "keepdims") + vi(3, 1) + vi(20, 2))
+    graph = (
+        node("ReduceMean", ["images"], ["m"], axes + keep)
+        + node("Reshape", ["m", "shape"], ["r"])
+        + node("Mul", ["r", "zero"], ["z"])
+        + node("Add", ["z", "preds"], ["output0"])
+        + ld(2, "const")
+        + ld(5, tensor("shape", np.array([1, 1, 1], dtype=np.int64)))
+        + ld(5, tensor("zero", np.zeros(1, dtype=np.float32)))
+        + ld(5, tensor("preds", preds.astype(np.float32)))
+        + ld(11, value_info("images", [1, 3, imgsz, imgsz]))
+        + ld(12, value_info("output0", list(preds.shape)))
+    )
+    with open(path, "wb") as f:
+        f.write(vi(1, 7) + ld(7, graph) + ld(8, vi(2, 13)))  # ir 7, opset 13
+
+
+if __name__ == "__main__":
+    # checks with a stub backend, python pipeline.py
+    import os
+    import tempfile
+
+    p = np.zeros((1, 84, 8400), dtype=np.float32)
+    p[0, :4, 0] = [320, 320, 64, 32]  # kept, class 3
+    p[0, 7, 0] = 0.9
+    p[0, :4, 1] = [322, 320, 64, 32]  # overlaps box 0 in its class, suppressed
+    p[0, 7, 1] = 0.8
+    p[0, :4, 2] = [100, 300, 20, 20]  # under the conf threshold
+    p[0, 4, 2] = 0.1
+
+    # 200x1280 letterboxes at r 0.5 with 270 rows of padding on top
+    img = np.zeros((200, 1280, 3), dtype=np.uint8)
+    pipe = Pipeline(StubBackend(p, 0.005), 640, 0.25, 0.45, 2)
+
+    # a frame of 4 cameras queued ahead of collecting the previous one,
+    # like object_detect does
+    for seq in range(10):
+        for i in range(4):
+            pipe.put((seq, i), img)
+        if seq:
+            for i in range(4):
+                tag, dets = pipe.get()
+                assert tag == (seq - 1, i), tag
+
+    assert dets.shape == (1, 6), dets
+    assert np.allclose(dets[0], [576, 68, 704, 132, 0.9, 3]), dets[0]
+
+    util = pipe.utilization()
+    assert set(util) == {"preprocess", "infer", "postprocess"}
+    assert all(0 <= v <= 1 for v in util.values()), util
+
+    # NMS is per class, the same overlapping box as class 5 is kept
+    q = p.copy()
+    q[0, 7, 1], q[0, 9, 1] = 0, 0.8
+    dets = pipe.postprocess((q, (0.5, (0, 270))))
+    assert sorted(dets[:, 5]) == [3, 5], dets
+
+    # CpuBackend through opencv dnn, on a model that outputs p
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "const.onnx")
+        const_onnx(path, p)
+        backend = get_backend(path)
+    assert isinstance(backend, CpuBackend)
+    blob = pipe.preprocess(img)[0]
+    assert blob.shape == (1, 3, 640, 640), blob.shape
+    out = backend(blob)
+    assert out.shape == (1, 84, 8400) and np.allclose(out, p), out.shape
+
+    cpu = Pipeline(backend, 640, 0.25, 0.45, 2)
+    cpu.put(0, img)
+    tag, dets = cpu.get()
+    assert tag == 0 and dets.shape == (1, 6), dets
+    assert np.allclose(dets[0], [576, 68, 704, 132, 0.9, 3]), dets[0]
+    cpu.close()
+    pipe.close()
+
+    # close() with every queue full and nobody reading
+    pipe = Pipeline(StubBackend(p, 0.05), 640, 0.25, 0.45, 1)
+    for seq in range(8):
+        pipe.put((seq, 0), img)
+    pipe.close()
+    assert not any(s.is_alive() for s in pipe.stages)
+
+    print("pipeline checks ok")
@@ -1,3 +1,6 @@
+import time
+from multiprocessing import Array, Condition, Value, shared_memory
+
 import numpy as np
 
 
@@ -14,9 +17,203 @@ def get_dim(w, h, dst_width):
     return int(scale * w), int(scale * h)
 
 
-def get_shm_frame(shm, sem, shape):
-    sem.acquire()
-    shm_array = np.ndarray(shape=shape, dtype=np.uint8, buffer=shm.buf)
-    frame = np.copy(shm_array)
-    sem.release()
-    return frame
+class SharedFrame(object):
+    """Ring of the latest frames in shared memory, with sequence numbers
+
+    put() writes frame seq into slot seq % slots and wakes the waiting
+    consumers, get() sleeps on the condition (futex backed semaphores on
+    linux) until a frame newer than the one the caller already has shows up.
+    A pool of n workers stripes the frames with stripe=(k, n), worker k only
+    takes seq % n == k. get() copies its slot outside the lock so put() is
+    never held up by a reader, slots >= n + 1 keeps the slot put() is
+    filling away from the newest frame of every stripe.
+    """
+
+    def __init__(self, size, slots=1):
+        self.size = size
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True, size=size * slots)
+        self.cond = Condition()
+        self.seq = Value("L", 0, lock=False)
+        self.tm = Array("d", slots, lock=False)
+
+    def put(self, frame, tm):
+        with self.cond:
+            k = (self.seq.value + 1) % self.slots
+            shm_array = np.ndarray(
+                shape=frame.shape,
+                dtype=np.uint8,
+                buffer=self.shm.buf,
+                offset=k * self.size,
+            )
+            np.copyto(shm_array, frame)
+            self.tm[k] = tm
+            self.seq.value += 1
+            self.cond.notify_all()
+
+    def get(self, shape, seq=0, max_age=0, stripe=(0, 1), timeout=1.0):
+        # frames older than max_age seconds are skipped, 0 keeps everything
+        k, n = stripe
+
+        def latest():  # newest frame in this stripe
+            s = self.seq.value
+            return s - (s - k) % n
+
+        def ready():
+            q = latest()
+            if q <= seq:
+                return False
+            return not max_age or time.time() - self.tm[q % self.slots] <= max_age
+
+        while True:
+            with self.cond:
+                if not self.cond.wait_for(ready, timeout):
+                    return seq, None
+                q = latest()
+                shm_array = np.ndarray(
+                    shape=shape,
+                    dtype=np.uint8,
+                    buffer=self.shm.buf,
+                    offset=(q % self.slots) * self.size,
+                )
+                if self.seq.value - q >= self.slots - 1:
+                    # the next put() writes this slot, ring too small
+                    return q, np.copy(shm_array)
+
+            # put() fills slot seq + 1 before moving seq on, the copy is
+            # good unless that slot came round to ours meanwhile
+            frame = np.copy(shm_array)
+            if self.seq.value - q < self.slots - 1:
+                return q, frame
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedImages(object):
+    """Display images of a worker pool in shared memory, keyed by seq
+
+    Workers put() the image of frame seq into slot seq % slots and only send
+    their result through the queue, the merge stage get()s the image back
+    when it releases the result. stamps holds [seq, h, w] per slot, seq is 0
+    while the slot is being written, so a reader whose slot was reused by a
+    newer frame gets None instead of a torn image.
+    """
+
+    def __init__(self, size, slots):
+        self.size = size
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True, size=size * slots)
+        self.stamps = Array("L", slots * 3, lock=False)
+
+    def _view(self, j, h, w):
+        return np.ndarray(
+            shape=(h, w, 3),
+            dtype=np.uint8,
+            buffer=self.shm.buf,
+            offset=j * self.size,
+        )
+
+    def put(self, seq, img):
+        j = seq % self.slots
+        h, w = img.shape[:2]
+        self.stamps[3 * j] = 0
+        np.copyto(self._view(j, h, w), img)
+        self.stamps[3 * j + 1 : 3 * j + 3] = [h, w]
+        self.stamps[3 * j] = seq
+
+    def get(self, seq):
+        j = seq % self.slots
+        if self.stamps[3 * j] != seq:
+            return None
+        h, w = self.stamps[3 * j + 1 : 3 * j + 3]
+        img = np.copy(self._view(j, h, w))
+        if self.stamps[3 * j] != seq:  # reused while we copied
+            return None
+        return img
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# ROI requests, consumer -> capture
+# rois is a multiprocessing Array("i", n * 3) of [active, x, y] slots,
+# x, y are in resized strip pixels
+def set_rois(rois, pts):
+    with rois.get_lock():
+        for k in range(len(rois) // 3):
+            if k < len(pts):
+                rois[3 * k : 3 * k + 3] = [1, int(pts[k][0]), int(pts[k][1])]
+            else:
+                rois[3 * k] = 0
+
+
+def get_rois(rois):
+    with rois.get_lock():
+        r = rois[:]
+    return [(r[k + 1], r[k + 2]) for k in range(0, len(r), 3) if r[k]]
+
+
+# full resolution crops, capture -> consumer
+# origins holds [valid, x0, y0] per slot in sensor pixels. Each published
+# set is handed out once, to the first worker of the pool that asks.
+def get_shm_crops(crops):
+    cs = crops["size"]
+    origins = crops["origins"]
+
+    crops["sem"].acquire()
+    if crops["seq"].value <= crops["taken"].value:
+        crops["sem"].release()
+        return []
+    crops["taken"].value = crops["seq"].value
+
+    o = origins[:]
+    n = len(o) // 3
+    arr = np.ndarray(shape=(n, cs, cs), dtype=np.uint8, buffer=crops["shm"].buf)
+    res = [(o[3 * k + 1], o[3 * k + 2], np.copy(arr[k])) for k in range(n) if o[3 * k]]
+    crops["sem"].release()
+    return res
+
+
+if __name__ == "__main__":
+    # checks, python utils.py
+    sf = SharedFrame(4, 3)
+
+    def put(s, tm=None):
+        sf.put(np.full(4, s, dtype=np.uint8), time.time() if tm is None else tm)
+
+    # stripe (2, 3) has nothing while seq < 2, latest() goes negative
+    put(1)
+    assert sf.get((4,), 0, stripe=(2, 3), timeout=0.05) == (0, None)
+    q, f = sf.get((4,), 0, stripe=(1, 3))
+    assert q == 1 and (f == 1).all(), (q, f)
+
+    # newest frame of each stripe, slots reused round the ring
+    for s in range(2, 9):
+        put(s)
+    for k, want in ((0, 6), (1, 7), (2, 8)):
+        q, f = sf.get((4,), 0, stripe=(k, 3))
+        assert q == want and (f == want).all(), (k, q, f)
+
+    # nothing newer than what the caller has
+    assert sf.get((4,), 8, timeout=0.05) == (8, None)
+
+    # stale frames are skipped with max_age
+    put(9, time.time() - 1)
+    assert sf.get((4,), 8, max_age=0.5, timeout=0.05) == (8, None)
+    q, f = sf.get((4,), 8)
+    assert q == 9 and (f == 9).all(), (q, f)
+    sf.close()
+
+    # display images, a reused slot reads as None
+    im = SharedImages(2 * 3 * 3, 2)
+    im.put(1, np.full((2, 3, 3), 1, dtype=np.uint8))
+    im.put(2, np.full((1, 3, 3), 2, dtype=np.uint8))
+    assert im.get(1).shape == (2, 3, 3) and im.get(2).shape == (1, 3, 3)
+    im.put(3, np.full((2, 3, 3), 3, dtype=np.uint8))
+    assert im.get(1) is None and (im.get(3) == 3).all()
+    im.close()
+
+    print("utils checks ok")